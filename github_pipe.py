@@ -5,12 +5,75 @@ version: 0.4.0
 description: Server-side pipe — model handles general queries via MCP tools, direct GitHub API handles table/chart formatting.
 """
 
+import asyncio
+import functools
+import hashlib
 import json
+import os
 import re
-import requests
-from typing import Optional, Tuple
+import tempfile
+import time
+import httpx
+from collections import Counter, OrderedDict
+from urllib.parse import urlencode
+from typing import AsyncIterator, NamedTuple, Optional, Tuple
 from pydantic import BaseModel, Field
 
+try:
+    import orjson
+except ImportError:  # optional speedup — fall back to the stdlib
+    orjson = None
+
+try:
+    import h2  # noqa: F401 — lets httpx negotiate HTTP/2 with api.github.com
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+def _json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def _json_dumps(obj) -> str:
+    return orjson.dumps(obj).decode() if orjson else json.dumps(obj)
+
+
+_NUMBER_UNITS = ((1_000_000, "M"), (1_000, "k"))
+
+
+@functools.lru_cache(maxsize=2048)
+def _fmt_number(n) -> str:
+    # Cached: star/issue counts repeat heavily across rows and requests
+    if n is None:
+        return "0"
+    n = int(n)
+    for limit, suffix in _NUMBER_UNITS:
+        if n >= limit:
+            return f"{n / limit:.1f}{suffix}"
+    return str(n)
+
+
+def _trunc(s, length=50) -> str:
+    if not s:
+        return "-"
+    s = str(s)
+    return s[:length] + "..." if len(s) > length else s
+
+
+def _request_schema(details: dict) -> dict:
+    """Return requestBody.content["application/json"].schema, or {} at the first missing level."""
+    node = details
+    for key in ("requestBody", "content", "application/json", "schema"):
+        node = node.get(key)
+        if not node:
+            return {}
+    return node
+
+
+GH_CACHE_SIZE = 128
+GH_CACHE_FRESH = 60  # seconds a cached GitHub response is served without revalidation
+TOOL_RESULT_MAX_BYTES = 6000
 
 PRIORITY_TOOLS = {
     "search_repositories", "search_code", "search_issues", "search_users",
@@ -19,6 +82,59 @@ PRIORITY_TOOLS = {
     "create_issue", "add_issue_comment",
 }
 
+_NOISE = frozenset({
+    "show", "display", "list", "get", "find", "search", "give", "me", "the", "a", "an", "in", "as", "for", "of",
+    "with", "top", "most", "popular", "trending", "recent", "latest", "new", "all", "some",
+    "table", "chart", "pie", "bar", "line", "tabular", "format", "graph",
+    "repositories", "repository", "repos", "repo", "projects", "issues", "prs", "bugs",
+    "by", "language", "stars", "sorted", "sort", "order",
+    "piechart", "piecharts", "piegraph", "piegraphs", "barchart", "barcharts", "bargraph", "bargraphs",
+    "linechart", "linecharts", "linegraph", "linegraphs",
+})
+_LANGS = frozenset({
+    "python", "javascript", "typescript", "java", "go", "rust",
+    "c++", "ruby", "swift", "kotlin", "dart", "php", "scala", "c", "shell",
+})
+_PIE_COMPOUNDS = ("piechart", "piecharts", "piegraph", "piegraphs")
+_BAR_COMPOUNDS = ("barchart", "barcharts", "bargraph", "bargraphs")
+_LINE_COMPOUNDS = ("linechart", "linecharts", "linegraph", "linegraphs")
+# Detector lexicon: keyword -> categories, so one pass over the tokens finds every category hit
+_KEYWORDS = {
+    **dict.fromkeys(("chart", "charts", "graph", "graphs"), ("chart",)),
+    **dict.fromkeys(("table", "tables", "tabular"), ("table",)),
+    "bar": ("bar",),
+    "line": ("line",),
+    **dict.fromkeys(_PIE_COMPOUNDS, ("chart",)),
+    **dict.fromkeys(_BAR_COMPOUNDS, ("chart", "bar")),
+    **dict.fromkeys(_LINE_COMPOUNDS, ("chart", "line")),
+    **dict.fromkeys(("issue", "issues", "bug", "bugs"), ("issue",)),
+    **dict.fromkeys(("pr", "prs"), ("pr",)),
+    "pull": ("pull",),
+    **dict.fromkeys(("request", "requests"), ("request",)),
+    **dict.fromkeys(("popular", "top", "trending"), ("popular",)),
+}
+# "pie-chart", "bar/line chart" etc. tokenize into their parts
+_SEPARATORS = str.maketrans("-/", "  ")
+_PUNCT = ".,!?;:()[]{}\"'`"
+_REPO_RE = re.compile(r'([\w.-]+/[\w.-]+)')
+_SPECIAL_TOKENS_RE = re.compile(r'<\|im_start\|>.*|<\|im_end\|>|<\|endoftext\|>', re.DOTALL)
+# Group 1: an existing ``` block (left untouched). Group 2: a bare mermaid directive line plus
+# its body — non-blank lines, and blank lines that are followed by a 4-space indented line.
+_MERMAID_FIX = re.compile(
+    r'^([ \t]*```[^\n]*(?:\n[\s\S]*?^[ \t]*```[^\n]*$|[\s\S]*))'
+    r'|^([ \t]*(?:pie(?: showData)?|xychart-beta|graph|flowchart|gantt)[ \t]*$'
+    r'(?:\n(?:[^\n]*\S[^\n]*|[ \t]*(?=\n    )))*)',
+    re.MULTILINE,
+)
+
+
+class Analysis(NamedTuple):
+    fmt: str
+    chart_type: str
+    search_type: str
+    query: str
+    sort: str
+
 
 class Pipe:
     class Valves(BaseModel):
@@ -28,6 +144,7 @@ class Pipe:
         NUM_CTX: int = Field(default=16384)
         MAX_TOOL_ROUNDS: int = Field(default=5)
         USE_ALL_TOOLS: bool = Field(default=False)
+        TOOLS_CACHE_TTL: int = Field(default=3600)
         GITHUB_TOKEN: str = Field(default="")
         SYSTEM_PROMPT: str = Field(
             default="You are a GitHub assistant. ALWAYS use the available tools to fetch real data. Never guess or make up information. Present results clearly."
@@ -36,66 +153,105 @@ class Pipe:
     def __init__(self):
         self.valves = self.Valves()
         self._tools_cache = None
+        # Pooled async connections: one client for api.github.com, one for MCPO/Ollama
+        limits = httpx.Limits(max_connections=20, max_keepalive_connections=20)
+        self._gh_client = httpx.AsyncClient(
+            base_url="https://api.github.com",
+            headers={"Accept": "application/vnd.github.v3+json"},
+            http2=HTTP2,
+            timeout=15,
+            limits=limits,
+        )
+        self._gh_token = None
+        self._gh_cache = OrderedDict()  # key -> (etag, body, ts)
+        self._mcp_client = httpx.AsyncClient(timeout=30, limits=limits)
+
+    async def close(self):
+        await self._gh_client.aclose()
+        await self._mcp_client.aclose()
 
-    # ── Format Detection ──────────────────────────────────────────
+    # ── Request Analysis ──────────────────────────────────────────
 
-    def _detect_format(self, user_msg: str) -> str:
-        msg = user_msg.lower()
-        if any(w in msg for w in ["pie chart", "bar chart", "chart", "line chart", "graph"]):
-            return "chart"
-        if any(w in msg for w in ["table", "tabular"]):
-            return "table"
-        return "default"
+    def _analyze(self, user_msg: str, lower_msg: str) -> Analysis:
+        """Single pass over the user message: format, chart type and search params.
 
-    def _detect_chart_type(self, user_msg: str) -> str:
-        msg = user_msg.lower()
-        if "bar" in msg:
-            return "bar"
-        if "line" in msg:
-            return "line"
-        return "pie"
+        `lower_msg` is `user_msg.lower()`, computed once by the caller.
+        """
+        tokens = [t.strip(_PUNCT) for t in lower_msg.translate(_SEPARATORS).split()]
+        hits = {c for t in tokens for c in _KEYWORDS.get(t, ())}
+
+        if "chart" in hits:
+            fmt = "chart"
+        elif "table" in hits:
+            fmt = "table"
+        else:
+            fmt = "default"
+
+        if "bar" in hits:
+            chart_type = "bar"
+        elif "line" in hits:
+            chart_type = "line"
+        else:
+            chart_type = "pie"
+
+        search_type, query, sort = self._extract_search_params(user_msg, tokens, hits)
+        return Analysis(fmt, chart_type, search_type, query, sort)
 
     # ── GitHub Direct API ─────────────────────────────────────────
 
-    def _github_api(self, endpoint: str, params: dict = None) -> dict:
-        headers = {"Accept": "application/vnd.github.v3+json"}
-        if self.valves.GITHUB_TOKEN:
-            headers["Authorization"] = f"Bearer {self.valves.GITHUB_TOKEN}"
+    async def _github_api(self, endpoint: str, params: dict = None) -> dict:
+        token = self.valves.GITHUB_TOKEN
+        if token != self._gh_token:
+            if token:
+                self._gh_client.headers["Authorization"] = f"Bearer {token}"
+            else:
+                self._gh_client.headers.pop("Authorization", None)
+            self._gh_token = token
+            self._gh_cache.clear()
+        params = params or {}
+        key = endpoint + "?" + urlencode(sorted(params.items()))
+        cached = self._gh_cache.get(key)
+        if cached:
+            self._gh_cache.move_to_end(key)
+            if time.time() - cached[2] < GH_CACHE_FRESH:
+                return cached[1]
+        headers = {"If-None-Match": cached[0]} if cached and cached[0] else {}
         try:
-            resp = requests.get(
-                f"https://api.github.com{endpoint}",
-                headers=headers,
-                params=params or {},
-                timeout=15,
-            )
-            return resp.json()
+            resp = await self._gh_client.get(endpoint, headers=headers, params=params)
+            if resp.status_code == 304 and cached:
+                self._gh_cache[key] = (cached[0], cached[1], time.time())
+                return cached[1]
+            data = _json_loads(resp.content)
         except Exception as e:
             return {"error": str(e)}
-
-    def _extract_search_params(self, user_msg: str) -> Tuple[str, str, str]:
-        """Extract (search_type, query, sort) from user message."""
-        msg = user_msg.lower()
-
+        if resp.status_code == 200:
+            self._gh_cache[key] = (resp.headers.get("ETag"), data, time.time())
+            self._gh_cache.move_to_end(key)
+            if len(self._gh_cache) > GH_CACHE_SIZE:
+                self._gh_cache.popitem(last=False)
+        return data
+
+    def _extract_search_params(self, user_msg: str, tokens: list, hits: set) -> Tuple[str, str, str]:
+        """Extract (search_type, query, sort) from the tokenized user message and its keyword hits."""
         # Detect search type
         search_type = "repos"
-        if any(w in msg for w in ["issue", "bug", "issues"]):
+        if "issue" in hits:
             search_type = "issues"
-        elif any(w in msg for w in ["pull request", "pr ", "prs", "pull requests"]):
+        elif "pr" in hits or {"pull", "request"} <= hits:
             search_type = "prs"
 
-        # Detect owner/repo pattern
-        repo_match = re.search(r'([\w.-]+/[\w.-]+)', user_msg)
-
-        # Extract keywords — remove noise words
-        clean = re.sub(
-            r'\b(show|display|list|get|find|search|give|me|the|a|an|in|as|for|of|'
-            r'with|top|most|popular|trending|recent|latest|new|all|some|'
-            r'table|chart|pie|bar|line|tabular|format|graph|'
-            r'repositories|repository|repos|repo|projects|issues|pull requests|prs|bugs|'
-            r'by|language|stars|sorted|sort|order)\b',
-            '', msg
-        )
-        keywords = [w.strip() for w in clean.split() if len(w.strip()) > 2]
+        # Detect owner/repo pattern — the pattern needs a literal "/", so skip the regex without one
+        repo_match = _REPO_RE.search(user_msg) if "/" in user_msg else None
+
+        # Extract keywords — drop noise words and the "pull request(s)" phrase
+        keywords = []
+        prev = ""
+        for t in tokens:
+            if prev == "pull" and t in ("request", "requests"):
+                keywords.pop()  # the "pull" appended on the previous token
+            elif len(t) > 2 and t not in _NOISE:
+                keywords.append(t)
+            prev = t
 
         # Build query
         sort = "stars"
@@ -103,12 +259,10 @@ class Pipe:
             query = f"repo:{repo_match.group(1)}"
             sort = "created"
         elif keywords:
-            languages = {"python", "javascript", "typescript", "java", "go", "rust",
-                         "c++", "ruby", "swift", "kotlin", "dart", "php", "scala", "c", "shell"}
-            lang_parts = [f"language:{k}" for k in keywords if k in languages]
-            topic_parts = [k for k in keywords if k not in languages]
+            lang_parts = [f"language:{k}" for k in keywords if k in _LANGS]
+            topic_parts = [k for k in keywords if k not in _LANGS]
             parts = topic_parts + lang_parts
-            if "popular" in msg or "top" in msg or "trending" in msg:
+            if "popular" in hits:
                 parts.append("stars:>100")
             query = " ".join(parts) if parts else "stars:>1000"
         else:
@@ -118,120 +272,94 @@ class Pipe:
 
     # ── Simple Formatters ─────────────────────────────────────────
 
-    def _fmt_number(self, n) -> str:
-        if n is None:
-            return "0"
-        n = int(n)
-        if n >= 1000000:
-            return f"{n/1000000:.1f}M"
-        if n >= 1000:
-            return f"{n/1000:.1f}k"
-        return str(n)
-
-    def _trunc(self, s, length=50) -> str:
-        if not s:
-            return "-"
-        s = str(s)
-        return s[:length] + "..." if len(s) > length else s
-
     def _repos_table(self, items) -> str:
-        lines = [
+        def row(i, r):
+            name = r.get("full_name") or r.get("name") or "?"
+            return (
+                f"| {i} | [{name}]({r.get('html_url', '#')}) | {_fmt_number(r.get('stargazers_count'))} "
+                f"| {r.get('language') or '-'} | {_trunc(r.get('description'), 60)} |"
+            )
+
+        return "\n".join([
             "| # | Repository | Stars | Language | Description |",
             "|---|-----------|-------|----------|-------------|",
-        ]
-        for i, r in enumerate(items[:15], 1):
-            name = r.get("full_name", r.get("name", "?"))
-            url = r.get("html_url", "#")
-            stars = self._fmt_number(r.get("stargazers_count", 0))
-            lang = r.get("language") or "-"
-            desc = self._trunc(r.get("description", "-"), 60)
-            lines.append(f"| {i} | [{name}]({url}) | {stars} | {lang} | {desc} |")
-        return "\n".join(lines)
+            *(row(i, r) for i, r in enumerate(items[:15], 1)),
+        ])
 
     def _repos_chart(self, items, chart_type) -> str:
         if chart_type == "pie":
-            lang_counts = {}
-            for r in items:
-                lang = r.get("language") or "Other"
-                lang_counts[lang] = lang_counts.get(lang, 0) + 1
+            lang_counts = Counter(r.get("language") or "Other" for r in items)
             pie = ['```mermaid', 'pie showData', '    title "Repositories by Language"']
-            for lang, count in sorted(lang_counts.items(), key=lambda x: -x[1])[:10]:
+            for lang, count in lang_counts.most_common(10):
                 pie.append(f'    "{lang}" : {count}')
             pie.append('```')
             return "\n".join(pie)
         else:
             # bar chart — top repos by stars
-            bar_items = sorted(items, key=lambda r: r.get("stargazers_count", 0), reverse=True)[:10]
-            names = [self._trunc(r.get("name", "?"), 15) for r in bar_items]
-            values = [r.get("stargazers_count", 0) for r in bar_items]
-            max_val = max(values) if values else 100
-            labels = ", ".join(f'"{n}"' for n in names)
-            vals = ", ".join(str(v) for v in values)
-            return f'```mermaid\nxychart-beta\n    title "Top Repositories by Stars"\n    x-axis [{labels}]\n    y-axis "Stars" 0 --> {int(max_val * 1.2)}\n    bar [{vals}]\n```'
+            bar_items = sorted(items, key=lambda r: r.get("stargazers_count") or 0, reverse=True)[:10]
+            labels = []
+            vals = []
+            for r in bar_items:
+                labels.append(f'"{_trunc(r.get("name") or "?", 15)}"')
+                vals.append(str(r.get("stargazers_count") or 0))
+            max_val = (bar_items[0].get("stargazers_count") or 0) if bar_items else 100
+            return f'```mermaid\nxychart-beta\n    title "Top Repositories by Stars"\n    x-axis [{", ".join(labels)}]\n    y-axis "Stars" 0 --> {int(max_val * 1.2)}\n    bar [{", ".join(vals)}]\n```'
+
+    @staticmethod
+    def _issue_row(i, iss, state) -> str:
+        title = _trunc(iss.get("title") or "?", 60)
+        author = (iss.get("user") or {}).get("login", "?")
+        created = str(iss.get("created_at") or "")[:10]
+        return f"| {i} | {state} | [#{iss.get('number', '')} {title}]({iss.get('html_url', '#')}) | @{author} | {created} |"
 
     def _issues_table(self, items) -> str:
-        lines = [
+        row = self._issue_row
+        return "\n".join([
             "| # | State | Issue | Author | Created |",
             "|---|-------|-------|--------|---------|",
-        ]
-        for i, iss in enumerate(items[:15], 1):
-            state = "Open" if iss.get("state") == "open" else "Closed"
-            title = self._trunc(iss.get("title", "?"), 60)
-            url = iss.get("html_url", "#")
-            num = iss.get("number", "")
-            author = iss.get("user", {}).get("login", "?")
-            created = str(iss.get("created_at", ""))[:10]
-            lines.append(f"| {i} | {state} | [#{num} {title}]({url}) | @{author} | {created} |")
-        return "\n".join(lines)
+            *(row(i, iss, "Open" if iss.get("state") == "open" else "Closed")
+              for i, iss in enumerate(items[:15], 1)),
+        ])
 
     def _prs_table(self, items) -> str:
-        lines = [
+        row = self._issue_row
+
+        def state(pr):
+            if (pr.get("pull_request") or {}).get("merged_at") or pr.get("merged_at"):
+                return "Merged"
+            return "Open" if pr.get("state") == "open" else "Closed"
+
+        return "\n".join([
             "| # | State | Pull Request | Author | Created |",
             "|---|-------|-------------|--------|---------|",
-        ]
-        for i, pr in enumerate(items[:15], 1):
-            merged = pr.get("pull_request", {}).get("merged_at") or pr.get("merged_at")
-            if merged:
-                state = "Merged"
-            elif pr.get("state") == "open":
-                state = "Open"
-            else:
-                state = "Closed"
-            title = self._trunc(pr.get("title", "?"), 60)
-            url = pr.get("html_url", "#")
-            num = pr.get("number", "")
-            author = pr.get("user", {}).get("login", "?")
-            created = str(pr.get("created_at", ""))[:10]
-            lines.append(f"| {i} | {state} | [#{num} {title}]({url}) | @{author} | {created} |")
-        return "\n".join(lines)
+            *(row(i, pr, state(pr)) for i, pr in enumerate(items[:15], 1)),
+        ])
 
     # ── Direct Search & Format (for table/chart) ──────────────────
 
-    def _direct_format(self, user_msg: str) -> Optional[str]:
+    async def _direct_format(self, analysis: Analysis) -> Optional[str]:
         """Bypass model: search GitHub API directly, return formatted table/chart."""
-        fmt = self._detect_format(user_msg)
-        chart_type = self._detect_chart_type(user_msg)
-        search_type, query, sort = self._extract_search_params(user_msg)
+        fmt, chart_type, search_type, query, sort = analysis
 
         if search_type == "repos":
-            data = self._github_api("/search/repositories", {"q": query, "sort": sort, "per_page": 15})
+            data = await self._github_api("/search/repositories", {"q": query, "sort": sort, "per_page": 15})
             items = data.get("items", [])
             if not items:
                 return None
             total = data.get("total_count", len(items))
-            header = f"Found **{self._fmt_number(total)}** repositories for `{query}`\n\n"
+            header = f"Found **{_fmt_number(total)}** repositories for `{query}`\n\n"
             if fmt == "table":
                 return header + self._repos_table(items)
             else:
                 return header + self._repos_chart(items, chart_type)
 
         elif search_type == "issues":
-            data = self._github_api("/search/issues", {"q": query + " is:issue", "sort": sort, "per_page": 15})
+            data = await self._github_api("/search/issues", {"q": query + " is:issue", "sort": sort, "per_page": 15})
             items = data.get("items", [])
             if not items:
                 return None
             total = data.get("total_count", len(items))
-            header = f"Found **{self._fmt_number(total)}** issues for `{query}`\n\n"
+            header = f"Found **{_fmt_number(total)}** issues for `{query}`\n\n"
             if fmt == "table":
                 return header + self._issues_table(items)
             else:
@@ -241,34 +369,85 @@ class Pipe:
                 return header + f'```mermaid\npie showData\n    title "Issues by State"\n    "Open" : {open_count}\n    "Closed" : {closed_count}\n```'
 
         elif search_type == "prs":
-            data = self._github_api("/search/issues", {"q": query + " is:pr", "sort": sort, "per_page": 15})
+            data = await self._github_api("/search/issues", {"q": query + " is:pr", "sort": sort, "per_page": 15})
             items = data.get("items", [])
             if not items:
                 return None
             total = data.get("total_count", len(items))
-            header = f"Found **{self._fmt_number(total)}** pull requests for `{query}`\n\n"
+            header = f"Found **{_fmt_number(total)}** pull requests for `{query}`\n\n"
             if fmt == "table":
                 return header + self._prs_table(items)
             else:
-                open_c = sum(1 for i in items if i.get("state") == "open")
-                merged_c = sum(1 for i in items if (i.get("pull_request", {}).get("merged_at") or i.get("merged_at")))
-                closed_c = len(items) - open_c - merged_c
+                open_c = merged_c = closed_c = 0
+                for i in items:
+                    if (i.get("pull_request") or {}).get("merged_at") or i.get("merged_at"):
+                        merged_c += 1
+                    elif i.get("state") == "open":
+                        open_c += 1
+                    else:
+                        closed_c += 1
                 return header + f'```mermaid\npie showData\n    title "Pull Requests by State"\n    "Open" : {open_c}\n    "Merged" : {merged_c}\n    "Closed" : {closed_c}\n```'
 
         return None
 
     # ── MCP Tool Helpers ──────────────────────────────────────────
 
-    def _fetch_tools(self) -> list:
+    def _tools_cache_path(self) -> str:
+        key = f"{self.valves.MCPO_BASE_URL}|{self.valves.USE_ALL_TOOLS}"
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(tempfile.gettempdir(), f"gh_mcp_tools_{digest}.json")
+
+    def _load_tools_file(self, path: str) -> Tuple[Optional[dict], bool]:
+        """Return (cached entry, fresh) from the on-disk tools cache."""
+        try:
+            age = time.time() - os.path.getmtime(path)
+            with open(path, "rb") as f:
+                cached = _json_loads(f.read())
+        except (OSError, ValueError):
+            return None, False
+        return cached, age < self.valves.TOOLS_CACHE_TTL
+
+    def _save_tools_file(self, path: str, tools: list, etag: Optional[str]):
+        try:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(_json_dumps({"etag": etag, "tools": tools}))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[GitHub MCP Agent] Failed to write tools cache: {e}")
+
+    async def _fetch_tools(self) -> list:
         if self._tools_cache is not None:
             return self._tools_cache
+
+        path = self._tools_cache_path()
+        cached, fresh = self._load_tools_file(path)
+        if cached and fresh:
+            self._tools_cache = cached["tools"]
+            return self._tools_cache
+
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
         try:
-            resp = requests.get(f"{self.valves.MCPO_BASE_URL}/openapi.json", timeout=10)
-            spec = resp.json()
+            resp = await self._mcp_client.get(f"{self.valves.MCPO_BASE_URL}/openapi.json", headers=headers, timeout=10)
+            if resp.status_code == 304 and cached:
+                os.utime(path)
+                self._tools_cache = cached["tools"]
+                return self._tools_cache
+            spec = _json_loads(resp.content)
         except Exception as e:
             print(f"[GitHub MCP Agent] Failed to fetch OpenAPI spec: {e}")
-            return []
+            return cached["tools"] if cached else []
 
+        tools = self._build_tools(spec)
+        if tools:
+            self._save_tools_file(path, tools, resp.headers.get("ETag"))
+        self._tools_cache = tools
+        print(f"[GitHub MCP Agent] Loaded {len(tools)} tools")
+        return tools
+
+    def _build_tools(self, spec: dict) -> list:
         tools = []
         schemas = spec.get("components", {}).get("schemas", {})
         for path, methods in spec.get("paths", {}).items():
@@ -279,15 +458,10 @@ class Pipe:
                 if not self.valves.USE_ALL_TOOLS and tool_name not in PRIORITY_TOOLS:
                     continue
                 description = details.get("description", details.get("summary", tool_name))
-                schema_ref = (
-                    details.get("requestBody", {})
-                    .get("content", {})
-                    .get("application/json", {})
-                    .get("schema", {})
-                )
+                schema_ref = _request_schema(details)
                 parameters = {"type": "object", "properties": {}, "required": []}
                 resolved = (
-                    schemas.get(schema_ref["$ref"].split("/")[-1], {})
+                    schemas.get(schema_ref["$ref"].rpartition("/")[2], {})
                     if "$ref" in schema_ref
                     else schema_ref
                 )
@@ -307,79 +481,113 @@ class Pipe:
                     "type": "function",
                     "function": {"name": tool_name, "description": description, "parameters": parameters},
                 })
-        self._tools_cache = tools
-        print(f"[GitHub MCP Agent] Loaded {len(tools)} tools")
         return tools
 
-    def _execute_tool(self, tool_name: str, arguments: dict) -> str:
+    async def _execute_tool(self, tool_name: str, arguments: dict) -> str:
         url = f"{self.valves.MCPO_BASE_URL}/{tool_name}"
         try:
-            resp = requests.post(url, json=arguments, headers={"Content-Type": "application/json"}, timeout=30)
-            result = resp.text
-            if len(result) > 6000:
-                result = result[:6000] + "\n... (truncated)"
+            # Stop reading once past the cap — the model never sees the rest, so don't download or decode it
+            chunks = []
+            total = 0
+            async with self._mcp_client.stream(
+                "POST", url, content=_json_dumps(arguments), headers={"Content-Type": "application/json"}
+            ) as resp:
+                async for chunk in resp.aiter_bytes(8192):
+                    chunks.append(chunk)
+                    total += len(chunk)
+                    if total > TOOL_RESULT_MAX_BYTES:
+                        break
+            result = b"".join(chunks)[:TOOL_RESULT_MAX_BYTES].decode("utf-8", "replace")
+            if total > TOOL_RESULT_MAX_BYTES:
+                result += "\n... (truncated)"
             return result
         except Exception as e:
-            return json.dumps({"error": str(e)})
+            return _json_dumps({"error": str(e)})
 
-    def _call_ollama(self, messages: list, tools: list) -> dict:
-        ollama_messages = []
-        for msg in messages:
-            m = {"role": msg["role"], "content": msg.get("content", "")}
-            if "tool_calls" in msg:
-                m["tool_calls"] = msg["tool_calls"]
-            if "tool_call_id" in msg:
-                m["tool_call_id"] = msg["tool_call_id"]
-            ollama_messages.append(m)
+    async def _stream_ollama(self, messages: list, ollama_tools: list) -> AsyncIterator[dict]:
+        """Yield the JSON chunks of a streamed Ollama chat completion.
 
-        ollama_tools = [{"type": "function", "function": t["function"]} for t in tools] if tools else []
+        `messages` must already be in Ollama's schema (normalized once in pipe()).
+        """
         payload = {
             "model": self.valves.MODEL_ID,
-            "messages": ollama_messages,
-            "stream": False,
+            "messages": messages,
+            "stream": True,
             "options": {"num_ctx": self.valves.NUM_CTX},
         }
         if ollama_tools:
             payload["tools"] = ollama_tools
-        resp = requests.post(f"{self.valves.OLLAMA_BASE_URL}/api/chat", json=payload, timeout=300)
-        return resp.json()
+        async with self._mcp_client.stream(
+            "POST",
+            f"{self.valves.OLLAMA_BASE_URL}/api/chat",
+            content=_json_dumps(payload),
+            headers={"Content-Type": "application/json"},
+            timeout=300,
+        ) as resp:
+            async for line in resp.aiter_lines():
+                if not line:
+                    continue
+                chunk = _json_loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"])
+                yield chunk
+                if chunk.get("done"):
+                    break
+
+    async def _stream_round(self, messages: list, ollama_tools: list, message: dict) -> AsyncIterator[str]:
+        """Run one Ollama turn, yielding cleaned content deltas as soon as they are stable.
+
+        Only `tool_calls` are buffered. The raw content and any tool calls are stored in
+        `message` (Ollama's schema) once the turn completes.
+        """
+        raw = ""
+        tool_calls = []
+        emitted = ""
+        async for chunk in self._stream_ollama(messages, ollama_tools):
+            msg = chunk.get("message", {})
+            if msg.get("tool_calls"):
+                tool_calls.extend(msg["tool_calls"])
+            piece = msg.get("content")
+            if not piece:
+                continue
+            raw += piece
+            if "\n" in piece:
+                stable = self._stable_clean(raw)
+                if len(stable) > len(emitted):
+                    yield stable[len(emitted):]
+                    emitted = stable
+        final = self._clean_response(raw)
+        if len(final) > len(emitted) and final.startswith(emitted):
+            yield final[len(emitted):]
+        message.update(role="assistant", content=raw)
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+
+    def _stable_clean(self, raw: str) -> str:
+        """_clean_response() of the complete lines in `raw`, minus anything later tokens could change."""
+        raw = _SPECIAL_TOKENS_RE.sub('', raw[:raw.rfind("\n") + 1])
+        # A bare mermaid block that runs to the end may still grow — hold it back until it closes
+        for m in _MERMAID_FIX.finditer(raw):
+            if m.group(2) is not None and not raw[m.end():].strip():
+                raw = raw[:m.start()]
+                break
+        return self._clean_response(raw)
 
     def _clean_response(self, content: str) -> str:
         # Strip leaked special tokens
-        content = re.sub(r'<\|im_start\|>.*', '', content, flags=re.DOTALL)
-        content = re.sub(r'<\|im_end\|>', '', content)
-        content = re.sub(r'<\|endoftext\|>', '', content)
+        content = _SPECIAL_TOKENS_RE.sub('', content)
 
         # Fix unfenced mermaid blocks
-        lines = content.split('\n')
-        result = []
-        in_mermaid = False
-        in_code = False
-        for i, line in enumerate(lines):
-            stripped = line.strip()
-            if stripped.startswith('```'):
-                in_code = not in_code
-            if not in_code and not in_mermaid and stripped in (
-                'pie', 'pie showData', 'xychart-beta', 'graph', 'flowchart', 'gantt'
-            ):
-                result.append('```mermaid')
-                in_mermaid = True
-                in_code = True
-            result.append(line)
-            if in_mermaid and i + 1 < len(lines) and lines[i + 1].strip() == '' and (
-                i + 2 >= len(lines) or not lines[i + 2].startswith('    ')
-            ):
-                result.append('```')
-                in_mermaid = False
-                in_code = False
-        if in_mermaid:
-            result.append('```')
-
-        return '\n'.join(result).strip()
+        content = _MERMAID_FIX.sub(
+            lambda m: m.group(1) if m.group(1) is not None else f"```mermaid\n{m.group(2)}\n```",
+            content,
+        )
+        return content.strip()
 
     # ── Main Pipe ─────────────────────────────────────────────────
 
-    async def pipe(self, body: dict, __event_emitter__=None) -> str:
+    async def pipe(self, body: dict, __event_emitter__=None) -> AsyncIterator[str]:
+        # Async generator: Open WebUI streams each yielded chunk (and joins them for non-stream requests)
         # Extract latest user message
         user_msg = ""
         for msg in reversed(body.get("messages", [])):
@@ -387,25 +595,29 @@ class Pipe:
                 c = msg.get("content", "")
                 user_msg = c if isinstance(c, str) else str(c)
                 break
+        lower_msg = user_msg.lower()
 
-        fmt = self._detect_format(user_msg)
+        analysis = self._analyze(user_msg, lower_msg)
 
         # ── FAST PATH: table/chart → direct GitHub API ──
-        if fmt in ("table", "chart"):
+        if analysis.fmt in ("table", "chart"):
             if __event_emitter__:
                 await __event_emitter__({"type": "status", "data": {"description": "Searching GitHub...", "done": False}})
 
-            result = self._direct_format(user_msg)
+            result = await self._direct_format(analysis)
 
             if __event_emitter__:
                 await __event_emitter__({"type": "status", "data": {"description": "", "done": True}})
 
             if result:
-                return result
+                yield result
+                return
             # If direct failed, fall through to model path
 
         # ── MODEL PATH: tool-calling loop via MCP ──
-        tools = self._fetch_tools()
+        tools = await self._fetch_tools()
+        ollama_tools = [{"type": "function", "function": t["function"]} for t in tools]
+        # Normalize inbound messages once; everything appended later is already in Ollama's schema
         messages = [{"role": "system", "content": self.valves.SYSTEM_PROMPT}]
         for msg in body.get("messages", []):
             role = msg.get("role", "user")
@@ -413,47 +625,67 @@ class Pipe:
             if isinstance(content, list):
                 parts = [p.get("text", "") if isinstance(p, dict) else str(p) for p in content]
                 content = "\n".join(parts)
-            messages.append({"role": role, "content": content})
+            m = {"role": role, "content": content}
+            if "tool_calls" in msg:
+                m["tool_calls"] = msg["tool_calls"]
+            if "tool_call_id" in msg:
+                m["tool_call_id"] = msg["tool_call_id"]
+            messages.append(m)
 
+        streamed = False
         for round_num in range(self.valves.MAX_TOOL_ROUNDS):
             if __event_emitter__:
                 await __event_emitter__({"type": "status", "data": {"description": f"Thinking... (round {round_num + 1})", "done": False}})
+            message = {}
+            sep = "\n\n" if streamed else ""
             try:
-                response = self._call_ollama(messages, tools)
+                async for delta in self._stream_round(messages, ollama_tools, message):
+                    yield sep + delta
+                    sep = ""
+                    streamed = True
             except Exception as e:
-                return f"Error calling Ollama: {str(e)}"
-
-            message = response.get("message", {})
-            tool_calls = message.get("tool_calls", None)
+                yield f"Error calling Ollama: {str(e)}"
+                return
+            tool_calls = message.get("tool_calls")
 
             if not tool_calls:
                 if __event_emitter__:
                     await __event_emitter__({"type": "status", "data": {"description": "", "done": True}})
-                model_text = self._clean_response(message.get("content", ""))
-                return model_text if model_text else "No response generated."
+                if not streamed:
+                    yield "No response generated."
+                return
 
             messages.append(message)
+            calls = []
             for tc in tool_calls:
                 func = tc.get("function", {})
                 tool_name = func.get("name", "")
                 arguments = func.get("arguments", {})
                 if isinstance(arguments, str):
                     try:
-                        arguments = json.loads(arguments)
-                    except json.JSONDecodeError:
+                        arguments = _json_loads(arguments)
+                    except ValueError:
                         arguments = {}
-                if __event_emitter__:
+                calls.append((tool_name, arguments))
+
+            # Independent calls to the same MCPO host — run them concurrently
+            if __event_emitter__:
+                for tool_name, _ in calls:
                     await __event_emitter__({"type": "status", "data": {"description": f"Calling {tool_name}...", "done": False}})
-                result = self._execute_tool(tool_name, arguments)
+            results = await asyncio.gather(*(self._execute_tool(name, args) for name, args in calls))
+            for result in results:
                 messages.append({"role": "tool", "content": result})
 
         # Max rounds reached — get final answer without tools
         if __event_emitter__:
             await __event_emitter__({"type": "status", "data": {"description": "Generating response...", "done": False}})
+        sep = "\n\n" if streamed else ""
         try:
-            response = self._call_ollama(messages, [])
-            if __event_emitter__:
-                await __event_emitter__({"type": "status", "data": {"description": "", "done": True}})
-            return self._clean_response(response.get("message", {}).get("content", ""))
+            async for delta in self._stream_round(messages, [], {}):
+                yield sep + delta
+                sep = ""
         except Exception as e:
-            return f"Error: {str(e)}"
+            yield f"Error: {str(e)}"
+            return
+        if __event_emitter__:
+            await __event_emitter__({"type": "status", "data": {"description": "", "done": True}})